@@ -39,16 +39,36 @@ along with WILDTRACK toolkit. If not, see <http://www.gnu.org/licenses/>.
 
 from tkinter import *
 from tkinter import messagebox
-from PIL import Image, ImageTk
 import os
+import base64
 import json
 import argparse
+import functools
 import cv2
+import numpy as np
 import math
+import platform
+import threading
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import orjson
+except ImportError:  # fall back to the (slower) standard library decoder
+    orjson = None
+try:
+    import simdjson
+except ImportError:  # the annotations are then decoded with read_json
+    simdjson = None
+try:
+    import liburing
+except ImportError:  # io_uring is optional, the frames are then read with cv2.imread
+    liburing = None
 
 
 _N_VIEWS = 7  # specific to WILDTRACK (used  only for warning)
+_USE_IO_URING = liburing is not None and platform.system() == 'Linux'
+_PPM_HEADER = b'P6\n%d %d\n255\n'  # binary RGB, of given width & height
+_CACHED_FRAMES = 9  # rendered multi-view frames kept in memory (~64 images for 7 views)
 
 
 def read_json(filename):
@@ -66,9 +86,13 @@ def read_json(filename):
     if not os.path.exists(filename):
         raise FileNotFoundError("File %s not found." % filename)
     try:
-        with open(filename, 'r') as _f:
-            _data = json.load(_f)
-    except json.JSONDecodeError:
+        if orjson is not None:
+            with open(filename, 'rb') as _f:
+                _data = orjson.loads(_f.read())
+        else:
+            with open(filename, 'r') as _f:
+                _data = json.load(_f)
+    except json.JSONDecodeError:  # orjson.JSONDecodeError is a subclass
         raise ValueError(f"Failed to decode {filename}.")
     if not isinstance(_data, list):
         raise TypeError(f"Decoded content is {type(_data)}. Expected list.")
@@ -77,6 +101,139 @@ def read_json(filename):
     return _data
 
 
+def _read_json_lazy(filename):
+    """
+    Decodes a JSON file using simdjson & returns its content.
+    As opposed to read_json, the elements of the returned arrays/objects
+    are decoded only when accessed, hence unused fields cost nothing.
+    Used only if simdjson is installed.
+
+    Raises:
+        FileNotFoundError: file not found
+        ValueError: failed to decode the JSON file
+        TypeError: the type of decoded content differs from the expected (list of dictionaries)
+
+    :param filename: [str] name of the JSON file
+    :return: [simdjson.Array] array of the annotations
+    """
+    if not os.path.exists(filename):
+        raise FileNotFoundError("File %s not found." % filename)
+    try:
+        with open(filename, 'rb') as _f:
+            _data = simdjson.Parser().parse(_f.read())
+    except ValueError:
+        raise ValueError(f"Failed to decode {filename}.")
+    if not isinstance(_data, simdjson.Array):
+        raise TypeError(f"Decoded content is {type(_data)}. Expected list.")
+    if len(_data) > 0 and not isinstance(_data[0], simdjson.Object):
+        raise TypeError(f"Decoded content is {type(_data[0])}. Expected dict.")
+    return _data
+
+
+def _boxes_array(_annotations, n_views):
+    """
+    Gathers the bounding boxes of the given annotations in a single array.
+
+    :param _annotations: [list] list of the annotations, see read_json & _read_json_lazy
+    :param n_views: [int] number of views
+    :return: [numpy.ndarray] int16 array of shape (n_views, len(_annotations), 4),
+             holding xmin, ymin, xmax, ymax of each bounding box
+    """
+    _boxes = np.array([[[_box['xmin'], _box['ymin'], _box['xmax'], _box['ymax']]
+                        for _box in (_views[view] for view in range(n_views))]
+                       for _views in (annotation['views'] for annotation in _annotations)],
+                      dtype=np.int16).reshape(len(_annotations), n_views, 4)
+    # contiguous per view, as the boxes are always accessed one view at a time
+    return np.ascontiguousarray(_boxes.transpose(1, 0, 2))
+
+
+@functools.lru_cache(maxsize=None)
+def _read_boxes(filename, n_views):
+    """
+    Decodes a JSON annotation file & returns its bounding boxes, see _boxes_array.
+    The result is cached (read-only), hence each file is decoded at most once.
+
+    Raises:
+        See functions read_json & _read_json_lazy
+
+    :param filename: [str] name of the JSON file
+    :param n_views: [int] number of views
+    :return: [numpy.ndarray] int16 array of shape (n_views, number of annotations, 4)
+    """
+    _annotations = read_json(filename) if simdjson is None else _read_json_lazy(filename)
+    _boxes = _boxes_array(_annotations, n_views)
+    _boxes.setflags(write=False)
+    return _boxes
+
+
+def _open_ring(entries):
+    """
+    Sets up an io_uring instance. Used only if liburing is installed (Linux).
+
+    Raises:
+        OSError: if io_uring is not available (e.g. disabled by the kernel)
+
+    :param entries: [int] number of requests that can be submitted at once
+    :return: [liburing.Ring] the io_uring instance
+    """
+    ring = liburing.Ring()
+    liburing.io_uring_queue_init(entries, ring)
+    return ring
+
+
+def _read_files(ring, filenames):
+    """
+    Reads the given files using io_uring, with a single batch of read requests.
+    The ring must have room for len(filenames) requests, and must not be used concurrently.
+
+    Raises:
+        OSError: if any of the files cannot be opened, or is not read entirely
+
+    :param ring: [liburing.Ring] io_uring instance, see _open_ring
+    :param filenames: [list of str] names of the files
+    :return: [list of bytearray] content of each of the files
+    """
+    _fds, _buffers = [], []
+    try:
+        # open all the files first, s.t. an error does not leave requests in the ring
+        for _filename in filenames:
+            _fds.append(os.open(_filename, os.O_RDONLY))
+            _buffers.append(bytearray(os.fstat(_fds[-1]).st_size))
+        for i, (_fd, _buffer) in enumerate(zip(_fds, _buffers)):
+            sqe = liburing.io_uring_get_sqe(ring)
+            liburing.io_uring_prep_read(sqe, _fd, _buffer, 0)
+            liburing.io_uring_sqe_set_data64(sqe, i)
+        liburing.io_uring_submit(ring)
+        # consume all the completions before checking them, s.t. none is left in the ring
+        cqe, _results = liburing.Cqe(), [0 for _ in filenames]
+        for _ in filenames:
+            liburing.io_uring_wait_cqe(ring, cqe)
+            _entry = cqe[0]
+            _results[_entry.user_data] = _entry.res
+            liburing.io_uring_cqe_seen(ring, _entry)
+    finally:
+        for _fd in _fds:
+            os.close(_fd)
+    for _filename, _buffer, _n_read in zip(filenames, _buffers, _results):
+        if _n_read < 0:
+            raise OSError(-_n_read, os.strerror(-_n_read), _filename)
+        if _n_read != len(_buffer):
+            raise OSError("Read %d out of %d bytes of %s." % (_n_read, len(_buffer), _filename))
+    return _buffers
+
+
+def _decode_image(_buffer):
+    """
+    Decodes an encoded image, as cv2.imread does for files.
+
+    :param _buffer: [bytes-like] content of an image file
+    :return: [numpy.ndarray] the decoded image (BGR), or None if decoding failed
+    """
+    if len(_buffer) == 0:
+        return None
+    return cv2.imdecode(np.frombuffer(_buffer, np.uint8), cv2.IMREAD_COLOR)
+
+
 def _subdirs(root_dir, _sort=True):
     """
     Returns a list of the sub-directories found in root_dir.
@@ -90,9 +247,8 @@ def _subdirs(root_dir, _sort=True):
     """
     if not os.path.isdir(root_dir):
         raise NotADirectoryError('%s is not a directory.' % root_dir)
-    _sub_dirs = [os.path.join(root_dir, dir_name)
-                 for dir_name in os.listdir(root_dir)
-                 if os.path.isdir(os.path.join(root_dir, dir_name))]
+    with os.scandir(root_dir) as entries:
+        _sub_dirs = [entry.path for entry in entries if entry.is_dir()]
     if _sort:
         _sub_dirs.sort()
     return _sub_dirs
@@ -112,8 +268,8 @@ def _files(root_dir, _extension, _sort=True):
     """
     if not os.path.isdir(root_dir):
         raise NotADirectoryError('%s is not a directory.' % root_dir)
-    files = [os.path.join(root_dir, _f) for _f in os.listdir(root_dir)
-             if os.path.isfile(os.path.join(root_dir, _f)) and _f.endswith(_extension)]
+    with os.scandir(root_dir) as entries:
+        files = [entry.path for entry in entries if entry.name.endswith(_extension) and entry.is_file()]
     if _sort:
         files.sort()
     return files
@@ -172,11 +328,17 @@ class AnnotationsViewer:
             _n_views: [int] number of views, equivalent to the subdirs found
             ann_filenames: [list of str] where each str is the absolute path of an annotation file
             current_frame: [int] ordering number of the annotation file currently shown
-            corresponding_frames: [list of PIL.ImageTk.PhotoImage] corresponding frames, i.e. frames
+            corresponding_frames: [list of tkinter.PhotoImage] corresponding frames, i.e. frames
                 from different cameras (subdirs), with the same timestamp
             im_height: [int] height of each frame
             im_width: [int] width of each frame
             frames_ext: [str] extension of the frames, obtained from the input arguments (opt)
+            _cached_render: [callable] memoized self._render_frame, keeps the last rendered frames
+            _io_pool: [concurrent.futures.ThreadPoolExecutor] used to load the views concurrently
+            _prefetch_pool: [concurrent.futures.ThreadPoolExecutor] single worker, renders the prefetched frames
+            _prefetching: [dict] futures of the prefetched frames, keyed by their ordering number
+            _ring: [liburing.Ring] io_uring instance used to read the frames, None if not available
+            _ring_lock: [threading.Lock] guards _ring, used also by the prefetch thread
 
         GUI related attributes:
             canvas, frames_on_canvas, navigate_frame, & 4 buttons
@@ -207,10 +369,19 @@ class AnnotationsViewer:
         self.im_height = None
         self.im_width = None
         self.frames_ext = opt.fr_ext
+        self._cached_render = functools.lru_cache(maxsize=_CACHED_FRAMES)(self._render_frame)
+        self._io_pool = ThreadPoolExecutor(max_workers=self.n_views)
+        self._prefetch_pool = ThreadPoolExecutor(max_workers=1)
+        self._prefetching = {}
+        self._ring = None
+        if _USE_IO_URING:
+            try:
+                self._ring = _open_ring(self.n_views)
+            except OSError:
+                pass  # the frames are then read with cv2.imread
+        self._ring_lock = threading.Lock()
         if self._verbose:
             print('Found %d files in: %s.' % (len(self.ann_filenames), _opt.dir_annotations))
-            print('Loaded %d multi-view annotations.' %
-                  sum([sum([1 for _ in read_json(f)]) for f in self.ann_filenames]))
         self.n_rows = 2
         self.n_columns = math.ceil((self.n_views + 1) / self.n_rows)
         self._load_and_draw_rect()
@@ -240,6 +411,7 @@ class AnnotationsViewer:
         self.prev10Btn.grid(row=1, column=0)
         self.next10Btn = Button(self.navigate_frame, text='>> +10', command=lambda: self._on_button(10))
         self.next10Btn.grid(row=1, column=1)
+        self._prefetch()
 
     def _on_button(self, step):
         """
@@ -260,17 +432,45 @@ class AnnotationsViewer:
             for view in range(self.n_views):
                 frame = self.corresponding_frames[view]
                 self.frames_on_canvas[view].configure(image=frame)
+            self._prefetch()
 
     def _load_and_draw_rect(self):
         """
         Loads the 'self.current_frame'-th frames and annotations.
+        Obtains the corresponding multi-view frames with the annotations
+        drawn on them (see self._render_frame), and updates self.corresponding_frames.
+        Helper function used by self.__init__, and self._on_button.
+
+        Raises:
+            See method self._render_frame (also if raised while prefetching the frame)
+
+        :return: [None]
+        """
+        _future = self._prefetching.pop(self.current_frame, None)
+        # if the frame is being prefetched, wait for it rather than rendering it twice
+        _images = self._cached_render(self.current_frame) if _future is None else _future.result()
+        for view in range(self.n_views):
+            self.corresponding_frames[view] = PhotoImage(data=_images[view])
+
+        if self._verbose:
+            _ann_filename = self.ann_filenames[self.current_frame]
+            _frame_timestamp = _ann_filename[_ann_filename.rfind("/") + 1:_ann_filename.rfind(".")]
+            _n_annotations = _read_boxes(_ann_filename, self.n_views).shape[1]
+            print("Frame %s [%3d/%3d]:\t%d multi-view annotations." %
+                  (_frame_timestamp, self.current_frame + 1, len(self), _n_annotations))
+
+    def _render_frame(self, _idx):
+        """
+        Loads the '_idx'-th frames and annotations.
         Loads the corresponding multi-view frames, 
         loads the annotations for these frames, 
-        and finally draws the annotations on the frames.
-        Updates self.corresponding_frames.
-        Helper function used by self.__init__, and self._on_button.
-        When called by __init__ it determines the size of the frames
+        draws the annotations on the frames, and resizes them for display.
+        The frames are returned as base64 encoded PPM images, which tkinter.PhotoImage
+        reads directly, s.t. only the PhotoImage objects are created in the GUI thread.
+        When called for the first time it determines the size of the frames
         based on the width/height of the screen.
+        Used through self._cached_render, so that frames which were already
+        displayed (or prefetched) are not loaded again.
         
         Assumption: 
             The images are named as the corresponding annotation file.
@@ -281,19 +481,24 @@ class AnnotationsViewer:
                                See also function read_json.
             ValueError: See function read_json
             TypeError: See function read_json
-        
-        :return: [None]
+
+        :param _idx: [int] ordering number of the annotation file
+        :return: [tuple of str] resized frames (base64 encoded PPM), one per view
         """
-        _ann_filename = self.ann_filenames[self.current_frame]
+        _ann_filename = self.ann_filenames[_idx]
         _frame_timestamp = _ann_filename[_ann_filename.rfind("/") + 1:_ann_filename.rfind(".")]
-        _annotations = read_json(_ann_filename)
+        _boxes = _read_boxes(_ann_filename, self.n_views)
+        _valid = self._visible(_boxes) & self._validate_box(_boxes)
 
-        for view in range(self.n_views):
-            img_pth = self.fr_sub_dirs[view] + '/' + _frame_timestamp + self.frames_ext
-            if not os.path.isfile(img_pth):
+        _paths = [self.fr_sub_dirs[view] + '/' + _frame_timestamp + self.frames_ext
+                  for view in range(self.n_views)]
+        _frames = self._read_frames(_paths)
+
+        _images = []
+        for view, frame in enumerate(_frames):
+            if frame is None:
                 raise FileNotFoundError("Corresponding frame %s of annotation file %s not found."
-                                        % (img_pth, _ann_filename))
-            frame = cv2.imread(img_pth)
+                                        % (_paths[view], _ann_filename))
 
             if self.im_height is None or self.im_width is None:
                 # determine display size per image, s.t. the aspect ratio is maintained
@@ -308,53 +513,89 @@ class AnnotationsViewer:
                 self.im_height = int(_im_height / _downscale_factor)
                 self.im_width = int(_im_width / _downscale_factor)
 
-            for annotation in _annotations:
-                bbox = annotation['views'][view]
-                if self._visible(bbox) and self._validate_box(bbox):
-                    cv2.rectangle(frame, (bbox['xmin'], bbox['ymin']), (bbox['xmax'], bbox['ymax']),
-                                  (255, 0, 0), 2)
-            frame = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-            frame = frame.resize((self.im_width, self.im_height), Image.ANTIALIAS)
-            self.corresponding_frames[view] = ImageTk.PhotoImage(frame)
+            for xmin, ymin, xmax, ymax in _boxes[view][_valid[view]].tolist():
+                cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), (255, 0, 0), 2)
+            # resize first, s.t. fewer pixels are color-converted
+            frame = cv2.resize(frame, (self.im_width, self.im_height), interpolation=cv2.INTER_AREA)
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            _ppm = _PPM_HEADER % (self.im_width, self.im_height) + frame.tobytes()
+            _images.append(base64.b64encode(_ppm).decode('ascii'))
+        return tuple(_images)
 
-        if self._verbose:
-            print("Frame %s [%3d/%3d]:\t%d multi-view annotations." %
-                  (_frame_timestamp, self.current_frame + 1, len(self), len(_annotations)))
+    def _read_frames(self, _paths):
+        """
+        Reads & decodes the given frames. On Linux, if liburing is installed, the files
+        are read with a single batch of io_uring requests (using self._ring),
+        otherwise, or if this fails, with cv2.imread.
+        Either way, the frames are decoded concurrently using self._io_pool
+        (OpenCV releases the GIL while decoding).
+        Helper function used by self._render_frame.
+
+        :param _paths: [list of str] paths of the frames
+        :return: [list of numpy.ndarray] loaded frames, None for frames which could not be loaded
+        """
+        if self._ring is not None:
+            try:
+                with self._ring_lock:
+                    _buffers = _read_files(self._ring, _paths)
+            except OSError:
+                pass  # e.g. missing frame, reported by the caller through the cv2.imread path
+            else:
+                return list(self._io_pool.map(_decode_image, _buffers))
+        return list(self._io_pool.map(cv2.imread, _paths))
+
+    def _prefetch(self):
+        """
+        Renders, using self._prefetch_pool, the frames that the navigation
+        buttons lead to (next frame, and 10 frames ahead), so that
+        sequential navigation does not wait for loading them.
+        Prefetches which are no longer needed are cancelled, if not started yet.
+        Errors are not reported here, these are stored in the futures
+        & raised when the frame is displayed (see self._load_and_draw_rect).
+        :return: [None]
+        """
+        _indices = [_idx for _idx in (self.current_frame + 1, self.current_frame + 10) if _idx < len(self)]
+        for _idx, _future in list(self._prefetching.items()):
+            if _future.done() or (_idx not in _indices and _future.cancel()):
+                del self._prefetching[_idx]
+        for _idx in _indices:
+            if _idx not in self._prefetching:
+                self._prefetching[_idx] = self._prefetch_pool.submit(self._cached_render, _idx)
 
     @staticmethod
-    def _visible(_box):
+    def _visible(_boxes):
         """
-        Checks if 3D position is visible for the particular view.
+        Checks if 3D positions are visible for the particular view.
         A position is visible, iff each of the coordinates of the bounding
         box is different than -1.
 
         Raises:
-            ValueError: if the input is not a dictionary
+            ValueError: if the input is not a numpy.ndarray (not checked with python -O)
 
-        :param _box: [dict] Bounding box coordinates, 
-                    {'xmin': _, 'ymin': _, 'xmax': _, 'ymax': _},
-                    where _ is an integer
-        :return: [bool] True if visible, False otherwise
+        :param _boxes: [numpy.ndarray] Bounding box coordinates, of shape (..., 4),
+                    where the last axis holds xmin, ymin, xmax, ymax
+        :return: [numpy.ndarray] boolean mask of shape (...), True if visible, False otherwise
         """
-        if not isinstance(_box, dict):
-            raise ValueError(f"Type mismatch. Found {type(_box)}, expected dict.")
-        return -1 not in _box.values()
+        if __debug__ and not isinstance(_boxes, np.ndarray):
+            raise ValueError(f"Type mismatch. Found {type(_boxes)}, expected numpy.ndarray.")
+        return (_boxes != -1).all(axis=-1)
 
     @staticmethod
-    def _validate_box(_box):
+    def _validate_box(_boxes):
         """
-        Checks if a bounding box (BB) is valid.
+        Checks if bounding boxes (BB) are valid.
         Given BB is valid if xmin < xmax & ymin < ymax.
 
         Raises:
-            ValueError: if the input is not a dictionary
+            ValueError: if the input is not a numpy.ndarray (not checked with python -O)
 
-        :param _box: [dict] Bounding box coordinates, {'xmin': _, 'ymin': _, 'xmax': _, 'ymax': _}
-        :return: [bool] True if valid, False otherwise
+        :param _boxes: [numpy.ndarray] Bounding box coordinates, of shape (..., 4),
+                    where the last axis holds xmin, ymin, xmax, ymax
+        :return: [numpy.ndarray] boolean mask of shape (...), True if valid, False otherwise
         """
-        if not isinstance(_box, dict):
-            raise ValueError(f"Type mismatch. Found {type(_box)}, expected dict.")
-        return True if _box['xmin'] < _box['xmax'] and _box['ymin'] < _box['ymax'] else False
+        if __debug__ and not isinstance(_boxes, np.ndarray):
+            raise ValueError(f"Type mismatch. Found {type(_boxes)}, expected numpy.ndarray.")
+        return (_boxes[..., 0] < _boxes[..., 2]) & (_boxes[..., 1] < _boxes[..., 3])
 
     def __len__(self):
         return len(self.ann_filenames)
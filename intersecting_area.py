@@ -40,12 +40,12 @@ along with WILDTRACK toolkit. If not, see <http://www.gnu.org/licenses/>.
 
 import os
 import argparse
+import hashlib
+import heapq
 import numpy as np
 import cv2
-from xml.dom import minidom
-from os import listdir
+from concurrent.futures import ThreadPoolExecutor
 from os.path import isfile, isdir, join, split, dirname, exists
-import xml.etree.ElementTree as ElementTree
 
 # specific to the WILDTRACK dataset:
 _grid_sizes = (1440, 480)
@@ -69,11 +69,11 @@ def load_opencv_xml(filename, element_name, dtype='float32'):
     if not isfile(filename):
         raise FileNotFoundError("File %s not found." % filename)
     try:
-        tree = ElementTree.parse(filename)
-        rows = int(tree.find(element_name).find('rows').text)
-        cols = int(tree.find(element_name).find('cols').text)
-        return np.fromstring(tree.find(element_name).find('data').text,
-                             dtype, count=rows*cols, sep=' ').reshape((rows, cols))
+        fs = cv2.FileStorage(filename, cv2.FILE_STORAGE_READ)
+        try:
+            return fs.getNode(element_name).mat().astype(dtype)
+        finally:
+            fs.release()
     except Exception as e:
         print(e)
         raise UnicodeDecodeError('Error while decoding file %s.' % filename)
@@ -98,6 +98,8 @@ def parse_args():
                         help="prefix for the output images, default: %(default)s")
     parser.add_argument('--fr_ext', type=str, default='.png',
                         help='extension of the frames, default: %(default)s')
+    parser.add_argument("--cache_dir", type=str, default="cache",
+                        help="directory where the generated grid is cached, default: %(default)s")
     _args = parser.parse_args()
     # Create the output directory if it does not exist:
     if dirname(_args.img_prefix) != "" and not exists(dirname(_args.img_prefix)):
@@ -137,16 +139,19 @@ def _load_imagas(_dirs, _n=0, _ext='png'):
     :param _ext: [str, optional] extension of the file/image, default: 'png'
     :return: [list of numpy.ndarray] loaded images
     """
-    _imgs = []
+    _paths = []
     for _, _dir in enumerate(_dirs):
         if not isdir(_dir):
             raise NotADirectoryError('%s is not a directory.' % _dir)
 
-        files = [join(_dir, f) for f in listdir(_dir) if isfile(join(_dir, f)) and f.endswith(_ext)]
+        with os.scandir(_dir) as entries:
+            files = [entry.path for entry in entries if entry.name.endswith(_ext) and entry.is_file()]
         if len(files) <= _n:
             raise IndexError("Found fewer files in %s than selected: %d" % (_dir, _n))
-        _imgs.append(cv2.imread(sorted(files)[_n]))
-    return _imgs
+        _paths.append(heapq.nsmallest(_n + 1, files)[-1])  # i.e. sorted(files)[_n]
+    # cv2.imread releases the GIL, hence the images are decoded concurrently
+    with ThreadPoolExecutor(max_workers=len(_paths)) as executor:
+        return list(executor.map(cv2.imread, _paths))
 
 
 def load_all_extrinsics(_lst_files):
@@ -156,6 +161,8 @@ def load_all_extrinsics(_lst_files):
     Raises:
         FileNotFoundError: see _load_content_lines
         ValueError: see _load_content_lines
+        FileNotFoundError: a listed extrinsic file is not found
+        ValueError: a listed extrinsic file does not contain rvec & tvec (3 elements each)
 
     :param _lst_files: [str] path of a file listing all the extrinsic calibration files
     :return: tuple of ([2D array], [2D array]) where the first and the second integers
@@ -166,15 +173,54 @@ def load_all_extrinsics(_lst_files):
     extrinsic_files = _load_content_lines(_lst_files)
     rvec, tvec = [], []
     for _file in extrinsic_files:
-        xmldoc = minidom.parse(_file)
-        rvec.append([float(number)
-                     for number in xmldoc.getElementsByTagName('rvec')[0].childNodes[0].nodeValue.strip().split()])
-        tvec.append([float(number)
-                     for number in xmldoc.getElementsByTagName('tvec')[0].childNodes[0].nodeValue.strip().split()])
+        if not isfile(_file):
+            raise FileNotFoundError("File %s not found." % _file)
+        fs = cv2.FileStorage(_file, cv2.FILE_STORAGE_READ)
+        try:
+            # rvec & tvec are sequences of numbers, rather than OpenCV matrices
+            _rvec, _tvec = fs.getNode('rvec'), fs.getNode('tvec')
+            if _rvec.size() != 3 or _tvec.size() != 3:
+                raise ValueError("File %s does not contain 3-element rvec and tvec." % _file)
+            rvec.append([_rvec.at(i).real() for i in range(_rvec.size())])
+            tvec.append([_tvec.at(i).real() for i in range(_tvec.size())])
+        finally:
+            fs.release()
     return rvec, tvec
 
 
-def project_grid_points(_origin, _size, _offset, rvec, tvec, camera_matrices, dist_coef):
+def _grid_points(_origin, _size, _offset, cache_dir=None):
+    """
+    Generates 3D points on a grid, on the ground plane (z-axis is 0).
+    If cache_dir is given, the grid is stored there, and loaded
+    (memory-mapped, read-only) by later calls with the same grid parameters.
+
+    :param _origin: [tuple] of the grid origin (x, y, z)
+    :param _size: [tuple] of the size (width, height) of the grid
+    :param _offset: [float] step for the grid density
+    :param cache_dir: [str, optional] directory where the grid is cached, default: None (no caching)
+    :return: [numpy.ndarray] float32 array of shape (width * height, 1, 3)
+    """
+    if cache_dir is not None:
+        _key = hashlib.sha1(repr((tuple(_origin), tuple(_size), float(_offset))).encode()).hexdigest()[:12]
+        _cache_file = join(cache_dir, "grid_%dx%d_%s.npy" % (_size[0], _size[1], _key))
+        if isfile(_cache_file):
+            return np.load(_cache_file, mmap_mode='r')
+
+    ix, iy = np.meshgrid(np.arange(_size[1]), np.arange(_size[0]))
+    points = np.stack([_origin[0] + _offset * ix,
+                       _origin[1] + _offset * iy,
+                       np.zeros_like(ix)],  # ground points, z-axis is 0
+                      axis=-1).reshape(-1, 1, 3).astype(np.float32)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        _tmp_file = _cache_file + ".%d.tmp.npy" % os.getpid()
+        np.save(_tmp_file, points)
+        os.replace(_tmp_file, _cache_file)  # atomic, s.t. a partially written grid is never loaded
+    return points
+
+
+def project_grid_points(_origin, _size, _offset, rvec, tvec, camera_matrices, dist_coef, cache_dir=None):
     """
     Generates 3D points on a grid & projects them into all the views,
     using the given extrinsic and intrinsic calibration parameters.
@@ -186,22 +232,26 @@ def project_grid_points(_origin, _size, _offset, rvec, tvec, camera_matrices, di
     :param tvec: [list] extrinsic parameters
     :param camera_matrices: [list] intrinsic parameters
     :param dist_coef: [list] intrinsic parameters
-    :return:
+    :param cache_dir: [str, optional] directory where the grid is cached, see _grid_points
+    :return: [list of numpy.ndarray] int16 arrays of shape (number of points, 2), one per view
     """
-    points = []
-    for i in range(_size[0] * _size[1]):
-        x = _origin[0] + _offset * (i % 480)
-        y = _origin[1] + _offset * (i / 480)
-        points.append(np.float32([[x, y, 0]]))  # ground points, z-axis is 0
-
-    projected = []
-    for c in range(len(camera_matrices)):
-        imgpts, _ = cv2.projectPoints(np.asarray(points),  # 3D points
-                                      np.asarray(rvec[c]),  # rotation rvec
-                                      np.asarray(tvec[c]),  # translation tvec
+    points = _grid_points(_origin, _size, _offset, cache_dir)
+
+    _rvec = [np.asarray(r) for r in rvec]
+    _tvec = [np.asarray(t) for t in tvec]
+
+    def _project(c):
+        imgpts, _ = cv2.projectPoints(points,  # 3D points
+                                      _rvec[c],  # rotation rvec
+                                      _tvec[c],  # translation tvec
                                       camera_matrices[c],  # camera matrix
                                       dist_coef[c])  # distortion coefficients
-        projected.append(imgpts)
+        # image coordinates fit in int16, points far outside of the image are clipped
+        return np.clip(imgpts.reshape(-1, 2), -32768, 32767).astype(np.int16)
+
+    # cv2.projectPoints releases the GIL, hence the views are projected concurrently
+    with ThreadPoolExecutor(max_workers=len(camera_matrices)) as executor:
+        projected = list(executor.map(_project, range(len(camera_matrices))))
     return projected
 
 
@@ -239,7 +289,7 @@ def draw_points(images, points):
         ValueError: the first dimension of the input does not match
 
     :param images: [list of numpy.ndarray] list of images
-    :param points: [list of numpy.ndarray] list of 2D points
+    :param points: [list of numpy.ndarray] list of 2D points, see project_grid_points
     :return: [None]
     """
     if not isinstance(images, list):
@@ -248,13 +298,19 @@ def draw_points(images, points):
         raise TypeError(f"Type mismatch. Found {type(points)}, expected list.")
     if not len(images) == len(points):
         raise ValueError("Length mismatch: %d and %d" % (len(images), len(points)))
-    for v in range(_n_views):
-        for p in range(len(projected[v])):
-            try:
-                if (points[v][p].ravel())[0] >= 0 and (points[v][p].ravel())[1] >= 0:
-                    cv2.circle(images[v], tuple(points[v][p].ravel()), 3, (255, 0, 0), -1)  # Blue
-            except OverflowError:
-                pass
+    # pixel offsets of a filled circle of radius 3
+    dx, dy = np.mgrid[-3:4, -3:4]
+    disk = dx * dx + dy * dy <= 9
+    offsets = np.stack([dx[disk], dy[disk]], axis=-1)
+    for v in range(len(images)):
+        _height, _width = images[v].shape[:2]
+        pts = points[v].reshape(-1, 2)
+        mask = (pts[:, 0] >= 0) & (pts[:, 1] >= 0) & (pts[:, 0] < _width) & (pts[:, 1] < _height)
+        pts = pts[mask]
+        xs = pts[:, 0, None] + offsets[:, 0]
+        ys = pts[:, 1, None] + offsets[:, 1]
+        inside = (xs >= 0) & (ys >= 0) & (xs < _width) & (ys < _height)
+        images[v][ys[inside], xs[inside]] = (255, 0, 0)  # Blue
 
 
 if __name__ == '__main__':
@@ -269,7 +325,7 @@ if __name__ == '__main__':
     _n_views = len(frames)
 
     projected = project_grid_points(_grid_origin, _grid_sizes, _grid_step,
-                                    rvec, tvec, cameraMatrices, distCoeffs)
+                                    rvec, tvec, cameraMatrices, distCoeffs, cache_dir=args.cache_dir)
     draw_points(frames, projected)
 
     for v in range(_n_views):